@@ -1,37 +1,57 @@
 # /// script
 # requires-python = ">=3.11"
 # dependencies = [
+#     "cachetools",
 #     "duckdb",
 #     "fastapi",
 #     "httpx",
 #     "langchain-community~=0.3.0",
 #     "langchain-openai~=0.2.0",
 #     "langchain~=0.3.0",
+#     "numpy>=2.0",
+#     "orjson",
 #     "pydantic",
 #     "pymupdf",
 #     "python-multipart",
-#     "uvicorn",
+#     "uvicorn[standard]",
 # ]
 # ///
+from cachetools import LRUCache, TTLCache
+from contextlib import contextmanager
 from datetime import datetime, timezone
-from fastapi import FastAPI, HTTPException, Depends, Query, UploadFile, File, Header
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, HTTPException, Depends, Query, UploadFile, File, Header, BackgroundTasks
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import ORJSONResponse
+from functools import lru_cache
+from itertools import islice
 from langchain_community.document_loaders import PyMuPDFLoader
-from langchain_community.vectorstores import DuckDB
 from langchain_openai import OpenAIEmbeddings
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 from pydantic import BaseModel, Field
 from typing import List, Dict, Optional, Any
+import asyncio
 import httpx
-import json
+import logging
+import orjson
 import os
 import shutil
 import sqlite3
 import tempfile
+import threading
+import time
 import uuid
 import duckdb
+import numpy as np
 
-app = FastAPI(title="RAG API", version="1.0.0")
+app = FastAPI(title="RAG API", version="1.0.0", default_response_class=ORJSONResponse)
+app.add_middleware(GZipMiddleware, minimum_size=1024)
+
+EMBED_BATCH_SIZE = 256
+EMBED_CONCURRENCY = 8
+UPLOAD_CHUNK_SIZE = 1 << 20
+# Search rescores this many candidates per requested result after the binary-signature prefilter
+SHORTLIST_FACTOR = 10
+_embed_semaphore = asyncio.Semaphore(EMBED_CONCURRENCY)
 
 async def get_token(authorization: str = Header(...)):
     if not authorization.startswith("Bearer "):
@@ -46,13 +66,201 @@ async def forward_request(url: str, method: str, token: str, **kwargs):
             raise HTTPException(status_code=response.status_code, detail=response.json())
         return response.json()
 
-def get_db():
-    db = sqlite3.connect("collections.db")
+# One long-lived connection per thread. Endpoints and the async ingestion task run on the event loop
+# thread; ingestion hands its blocking calls to asyncio.to_thread workers. Writes are serialized via a
+# lock so WAL readers never wait on each other.
+_db_local = threading.local()
+_db_write_lock = threading.Lock()
+
+def _connect():
+    db = sqlite3.connect("collections.db", check_same_thread=False, isolation_level=None)
     db.row_factory = sqlite3.Row
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("PRAGMA synchronous=NORMAL")
+    db.execute("PRAGMA temp_store=MEMORY")
+    db.execute("PRAGMA cache_size=-20000")  # 20 MB page cache
+    db.execute("PRAGMA mmap_size=268435456")  # Read up to 256 MB via mmap instead of read() calls
     return db
 
-with get_db() as db:
+@contextmanager
+def get_db(write: bool = False):
+    db = getattr(_db_local, "db", None)
+    if db is None:
+        db = _db_local.db = _connect()
+    if not write:
+        yield db
+        return
+    # BEGIN IMMEDIATE takes the write lock up front, so each block commits (and syncs) once
+    with _db_write_lock:
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            yield db
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        db.execute("COMMIT")
+
+# Filterable/sortable fields get their own indexed columns. `data` keeps the full document, including
+# fields added later that don't have a column yet.
+COLLECTION_COLUMNS = ("name", "embedding_model", "created_at", "authors_json", "extraction_strategy_json")
+SORT_COLUMNS = {"id", "name", "embedding_model", "created_at"}
+
+with get_db(write=True) as db:
     db.execute("CREATE TABLE IF NOT EXISTS collections (id TEXT PRIMARY KEY, data JSON)")
+    # Databases created before the columns existed are migrated in place
+    existing_columns = {row["name"] for row in db.execute("PRAGMA table_info(collections)")}
+    for column in COLLECTION_COLUMNS:
+        if column not in existing_columns:
+            db.execute(f"ALTER TABLE collections ADD COLUMN {column} TEXT")
+    db.execute("""UPDATE collections SET
+        name = json_extract(data, '$.name'),
+        embedding_model = json_extract(data, '$.embedding_model'),
+        created_at = json_extract(data, '$.created_at'),
+        authors_json = json_extract(data, '$.authors'),
+        extraction_strategy_json = json_extract(data, '$.extraction_strategy')
+        WHERE name IS NULL""")
+    for column in ("name", "embedding_model", "created_at"):
+        db.execute(f"CREATE INDEX IF NOT EXISTS idx_coll_{column} ON collections({column})")
+    db.execute("CREATE TABLE IF NOT EXISTS documents (file_id TEXT PRIMARY KEY, collection_id TEXT, file_name TEXT, status TEXT)")
+    db.execute("CREATE INDEX IF NOT EXISTS idx_documents_collection ON documents(collection_id)")
+
+# Statements run per request. Keeping each as one constant string means sqlite3's per-connection
+# statement cache (keyed on the SQL text) always hits and never re-prepares them.
+SQL_GET_COLLECTION = "SELECT data FROM collections WHERE id = ?"
+SQL_INSERT_COLLECTION = ("INSERT INTO collections (name, embedding_model, created_at, authors_json, "
+                         "extraction_strategy_json, data, id) VALUES (?, ?, ?, ?, ?, ?, ?)")
+SQL_DELETE_COLLECTION = "DELETE FROM collections WHERE id = ?"
+SQL_INSERT_DOCUMENT = "INSERT INTO documents (file_id, collection_id, file_name, status) VALUES (?, ?, ?, ?)"
+SQL_GET_DOCUMENT = "SELECT file_id, file_name, status FROM documents WHERE file_id = ? AND collection_id = ?"
+SQL_SET_DOCUMENT_STATUS = "UPDATE documents SET status = ? WHERE file_id = ?"
+SQL_DELETE_DOCUMENT = "DELETE FROM documents WHERE file_id = ? AND collection_id = ?"
+SQL_DELETE_COLLECTION_DOCUMENTS = "DELETE FROM documents WHERE collection_id = ?"
+
+# Hot collections are looked up on every document/search request. Writes evict their entry.
+_collection_cache = TTLCache(maxsize=1024, ttl=30)
+
+def _load_collection(collection_id: str) -> dict:
+    data = _collection_cache.get(collection_id)
+    if data is None:
+        with get_db() as db:
+            result = db.execute(SQL_GET_COLLECTION, (collection_id,)).fetchone()
+        if not result:
+            raise HTTPException(status_code=404, detail="Collection not found")
+        data = _collection_cache[collection_id] = orjson.loads(result['data'])
+    return data
+
+# Each collection's vectors live in {collection_id}.duckdb. Keep recently used collections' connections
+# open instead of reopening the file on every upload and search. Each open file is a separate DuckDB
+# instance with its own buffer pool and an exclusive file lock, so the cache is bounded. Evicted
+# connections aren't closed here: a worker thread may still be using one, and closing it would break
+# its cursors. DuckDB closes it, releasing the file, once the last reference is gone. The lock also
+# means one process (one uvicorn worker) owns the vector stores.
+_vector_dbs = LRUCache(maxsize=32)
+_vector_dbs_lock = threading.Lock()
+
+def _vector_db(collection_id: str) -> duckdb.DuckDBPyConnection:
+    with _vector_dbs_lock:
+        conn = _vector_dbs.get(collection_id)
+        if conn is None:
+            conn = duckdb.connect(database=f"{collection_id}.duckdb", config={
+                "enable_external_access": "false",
+                "autoinstall_known_extensions": "false",
+                "autoload_known_extensions": "false"
+            })
+            conn.execute("CREATE TABLE IF NOT EXISTS embeddings (id VARCHAR PRIMARY KEY, text VARCHAR, embedding BLOB, metadata VARCHAR)")
+            conn.execute("ALTER TABLE embeddings ADD COLUMN IF NOT EXISTS signature BLOB")
+            conn.execute("ALTER TABLE embeddings ADD COLUMN IF NOT EXISTS file_id VARCHAR")
+            conn.execute("CREATE TABLE IF NOT EXISTS quantization (lo DOUBLE, hi DOUBLE)")
+            _vector_dbs[collection_id] = conn
+    return conn
+
+# Embeddings are stored as uint8 codes over a per-collection [lo, hi] range: 4x smaller than float32.
+# Codes are bound as raw bytes. DuckDB binds a Python list into a LIST column element by element.
+# The first ingested batch fixes the range; later vectors are clipped to it.
+def _quantize(conn: duckdb.DuckDBPyConnection, vectors: np.ndarray) -> np.ndarray:
+    bounds = conn.execute("SELECT lo, hi FROM quantization").fetchone()
+    if bounds is None:
+        bounds = float(vectors.min()), float(vectors.max())
+        conn.execute("INSERT INTO quantization VALUES (?, ?)", bounds)
+    lo, hi = bounds
+    return np.clip(np.rint((vectors - lo) * (255 / ((hi - lo) or 1))), 0, 255).astype(np.uint8)
+
+def _dequantize(codes: np.ndarray, lo: float, hi: float) -> np.ndarray:
+    return codes.astype(np.float32) * np.float32((hi - lo) / 255) + np.float32(lo)
+
+# 1 bit per dimension (the sign). Hamming distance between signatures approximates angular distance,
+# so search ranks all chunks on these 32x smaller codes and rescores only a shortlist exactly.
+def _signature(vectors: np.ndarray) -> np.ndarray:
+    return np.packbits(vectors > 0, axis=-1)
+
+def _hamming(signatures: np.ndarray, query_signature: np.ndarray) -> np.ndarray:
+    return np.bitwise_count(signatures ^ query_signature).sum(axis=-1)
+
+# Search keeps each recently used collection's ids, signatures and unit-normalized float16 vectors in
+# memory, so a query is one matrix-vector product instead of a DuckDB scan + dequantize. Writes evict.
+# Indexes are built and evicted from worker threads too, so the cache is locked. Each eviction bumps
+# the collection's version, and a build only caches its result if no write happened while it read.
+_search_indexes = LRUCache(maxsize=32)
+_search_index_versions: Dict[str, int] = {}
+_search_indexes_lock = threading.Lock()
+
+def _evict_search_index(collection_id: str):
+    with _search_indexes_lock:
+        _search_indexes.pop(collection_id, None)
+        _search_index_versions[collection_id] = _search_index_versions.get(collection_id, 0) + 1
+
+def _search_index(collection_id: str) -> tuple:
+    with _search_indexes_lock:
+        index = _search_indexes.get(collection_id)
+        version = _search_index_versions.get(collection_id, 0)
+    if index is not None:
+        return index
+    with _vector_db(collection_id).cursor() as conn:
+        rows = conn.execute("SELECT id, embedding, signature FROM embeddings").fetchall()
+        bounds = conn.execute("SELECT lo, hi FROM quantization").fetchone()
+    if rows:
+        codes = np.frombuffer(b"".join(row[1] for row in rows), dtype=np.uint8).reshape(len(rows), -1)
+        matrix = _dequantize(codes, *bounds)
+        matrix /= np.linalg.norm(matrix, axis=1, keepdims=True)
+        signatures = _signature(matrix)
+        # Prefer signatures taken from the unquantized vectors at ingestion time
+        stored = [i for i, row in enumerate(rows) if row[2] is not None]
+        if stored:
+            signatures[stored] = np.frombuffer(b"".join(rows[i][2] for i in stored), dtype=np.uint8).reshape(len(stored), -1)
+    else:
+        matrix, signatures = np.empty((0, 0), dtype=np.float32), np.empty((0, 0), dtype=np.uint8)
+    index = ([row[0] for row in rows], signatures, matrix.astype(np.float16))
+    with _search_indexes_lock:
+        if _search_index_versions.get(collection_id, 0) == version:
+            _search_indexes[collection_id] = index
+    return index
+
+def _fetch_chunks(collection_id: str, ids: List[str]) -> dict:
+    with _vector_db(collection_id).cursor() as conn:
+        rows = conn.execute("SELECT id, text, metadata FROM embeddings WHERE id IN (SELECT UNNEST(?))", (ids,)).fetchall()
+    return {row[0]: row for row in rows}
+
+# Called from worker threads. A DuckDB connection must not be shared across threads, so each call writes
+# through its own cursor. Writes are serialized so concurrent first uploads agree on one quantization range.
+_vector_write_lock = threading.Lock()
+
+def _store_chunks(collection_id: str, file_id: str, window: list, vectors: np.ndarray):
+    with _vector_write_lock, _vector_db(collection_id).cursor() as conn:
+        codes, signatures = _quantize(conn, vectors), _signature(vectors)
+        conn.executemany("INSERT INTO embeddings (id, text, embedding, metadata, signature, file_id) VALUES (?, ?, ?, ?, ?, ?)", [
+            (str(uuid.uuid4()), text, code.tobytes(), orjson.dumps(metadata).decode(), signature.tobytes(), file_id)
+            for (text, metadata), code, signature in zip(window, codes, signatures)
+        ])
+
+def _drop_vector_db(collection_id: str):
+    _evict_search_index(collection_id)
+    with _vector_dbs_lock:
+        conn = _vector_dbs.pop(collection_id, None)
+    if conn is not None:
+        conn.close()
+    for path in (f"{collection_id}.duckdb", f"{collection_id}.duckdb.wal"):
+        if os.path.exists(path):
+            os.unlink(path)
 
 class ErrorResponse(BaseModel):
     message: str
@@ -69,6 +277,10 @@ class Collection(BaseModel):
     embedding_model: str
     # Add any future fields here
 
+class CollectionsPage(BaseModel):
+    collections: List[Collection]
+    total: int
+
 class CollectionCreate(BaseModel):
     name: str = Field(..., description="The name of the collection")
     authors: List[str] = Field(..., description="List of authors for the collection")
@@ -100,7 +312,33 @@ class SearchResponse(BaseModel):
     total: int
     processing_time: str
 
-@app.get("/v1/collections")
+@lru_cache(maxsize=256)
+def _build_query(filter_keys: tuple, sort: Optional[str]) -> str:
+    query = "SELECT data, COUNT(*) OVER () AS total FROM collections"
+
+    if filter_keys:
+        conditions = []
+        for k in filter_keys:
+            if k == "authors":
+                conditions.append("EXISTS (SELECT 1 FROM json_each(authors_json) WHERE value = ?)")
+            elif k in SORT_COLUMNS:
+                conditions.append(f"{k} = ?")
+            else:
+                raise HTTPException(status_code=400, detail=f"Cannot filter by {k}")
+        query += " WHERE " + " AND ".join(conditions)
+
+    if sort:
+        sort_fields = []
+        for field in sort.split(','):
+            name, order = (field[1:], "DESC") if field.startswith('-') else (field, "ASC")
+            if name not in SORT_COLUMNS:
+                raise HTTPException(status_code=400, detail=f"Cannot sort by {name}")
+            sort_fields.append(f"{name} {order}")
+        query += " ORDER BY " + ", ".join(sort_fields)
+
+    return query + " LIMIT ? OFFSET ?"
+
+@app.get("/v1/collections", response_model=CollectionsPage)
 async def list_collections(
     page: int = Query(1, ge=1),
     per_page: int = Query(10, ge=1, le=100),
@@ -108,134 +346,201 @@ async def list_collections(
     sort: Optional[str] = Query(None, description="Format: field1,-field2,field3")
 ):
     offset = (page - 1) * per_page
-    query = "SELECT data FROM collections"
-    params = []
-
-    filters_dict = json.loads(filters)
-    if filters_dict:
-        query += " WHERE " + " AND ".join(f"json_extract(data, '$.{k}') = ?" for k in filters_dict)
-        params.extend(filters_dict.values())
-
-    if sort:
-        sort_fields = []
-        for field in sort.split(','):
-            if field.startswith('-'):
-                sort_fields.append(f"json_extract(data, '$.{field[1:]}') DESC")
-            else:
-                sort_fields.append(f"json_extract(data, '$.{field}') ASC")
-        query += " ORDER BY " + ", ".join(sort_fields)
-
-    query += " LIMIT ? OFFSET ?"
-    params.extend([per_page, offset])
+    try:
+        filters_dict = orjson.loads(filters)
+    except orjson.JSONDecodeError:
+        raise HTTPException(status_code=400, detail="filters must be a JSON object")
+    if not isinstance(filters_dict, dict):
+        raise HTTPException(status_code=400, detail="filters must be a JSON object")
+    for k, v in filters_dict.items():
+        if not isinstance(v, (str, int, float)):
+            raise HTTPException(status_code=400, detail=f"Filter {k} must be a string or number")
+    filter_keys = tuple(sorted(filters_dict))
+    query = _build_query(filter_keys, sort)
+    params = [*(filters_dict[k] for k in filter_keys), per_page, offset]
 
     with get_db() as db:
-        results = [json.loads(row['data']) for row in db.execute(query, params)]
-        total = db.execute("SELECT COUNT(*) FROM collections").fetchone()[0]
+        rows = db.execute(query, params).fetchall()
+    results = [Collection(**orjson.loads(row['data'])) for row in rows]
+    total = rows[0]['total'] if rows else 0
 
-    return {"collections": results, "total": total}
+    return CollectionsPage(collections=results, total=total)
 
-@app.get("/v1/collections/{collection_id}")
+@app.get("/v1/collections/{collection_id}", response_model=Collection)
 async def get_collection(collection_id: str):
-    with get_db() as db:
-        result = db.execute("SELECT data FROM collections WHERE id = ?", (collection_id,)).fetchone()
-        if not result:
-            raise HTTPException(status_code=404, detail="Collection not found")
-    return json.loads(result['data'])
+    return Collection(**_load_collection(collection_id))
 
-@app.post("/v1/collections", status_code=201)
+def _new_collection(collection: CollectionCreate) -> Collection:
+    # The request body is already validated and id/created_at are generated here, so skip re-validation
+    return Collection.model_construct(id=str(uuid.uuid4()), created_at=datetime.now(timezone.utc), **collection.model_dump())
+
+def _collection_row(collection: Collection) -> tuple:
+    return (collection.name, collection.embedding_model, collection.created_at.isoformat(),
+            orjson.dumps(collection.authors).decode(), orjson.dumps(collection.extraction_strategy).decode(),
+            orjson.dumps(collection.model_dump()).decode(), collection.id)
+
+@app.post("/v1/collections", response_model=Collection, status_code=201)
 async def create_collection(collection: CollectionCreate):
-    collection_id = str(uuid.uuid4())
-    data = collection.model_dump()
-    data['id'] = collection_id
-    data['created_at'] = datetime.now(timezone.utc).isoformat()
+    result = _new_collection(collection)
 
-    with get_db() as db:
-        db.execute("INSERT INTO collections (id, data) VALUES (?, ?)",
-                   (collection_id, json.dumps(data)))
+    with get_db(write=True) as db:
+        db.execute(SQL_INSERT_COLLECTION, _collection_row(result))
 
-    return data
+    return result
 
-@app.patch("/v1/collections/{collection_id}")
-async def update_collection(collection_id: str, update_data: CollectionUpdate):
-    with get_db() as db:
-        existing = db.execute("SELECT data FROM collections WHERE id = ?", (collection_id,)).fetchone()
-        if not existing:
-            raise HTTPException(status_code=404, detail="Collection not found")
+@app.post("/v1/collections:batch", response_model=CollectionsPage, status_code=201)
+async def create_collections_bulk(collections: List[CollectionCreate]):
+    results = [_new_collection(collection) for collection in collections]
 
-        data = json.loads(existing['data'])
-        data.update({k: v for k, v in update_data.model_dump().items() if v is not None})
+    with get_db(write=True) as db:
+        db.executemany(SQL_INSERT_COLLECTION, map(_collection_row, results))
 
-        db.execute("UPDATE collections SET data = ? WHERE id = ?",
-                   (json.dumps(data), collection_id))
+    return CollectionsPage(collections=results, total=len(results))
 
-    return data
+# Column holding each updatable field. The *_json columns hold the field's JSON text.
+UPDATE_COLUMNS = {"name": "name", "embedding_model": "embedding_model", "authors": "authors_json",
+                  "extraction_strategy": "extraction_strategy_json"}
+
+@lru_cache(maxsize=16)
+def _build_update(keys: tuple) -> str:
+    columns = "".join(f"{UPDATE_COLUMNS[k]} = ?, " for k in keys)
+    paths = "".join(f", '$.{k}', json(?)" for k in keys)
+    return f"UPDATE collections SET {columns}data = json_set(data{paths}) WHERE id = ? RETURNING data"
+
+@app.patch("/v1/collections/{collection_id}", response_model=Collection)
+async def update_collection(collection_id: str, update_data: CollectionUpdate):
+    changes = {k: v for k, v in update_data.model_dump().items() if v is not None}
+    values = [orjson.dumps(v).decode() for v in changes.values()]
+    columns = [v if isinstance(v, str) else value for v, value in zip(changes.values(), values)]
+
+    # Patch the stored document in SQL and read it back in the same statement
+    with get_db(write=True) as db:
+        result = db.execute(_build_update(tuple(changes)), (*columns, *values, collection_id)).fetchone()
+        if not result:
+            raise HTTPException(status_code=404, detail="Collection not found")
+    _collection_cache.pop(collection_id, None)
+
+    return Collection(**orjson.loads(result['data']))
 
 @app.delete("/v1/collections/{collection_id}", status_code=204)
 async def delete_collection(collection_id: str):
-    with get_db() as db:
-        result = db.execute("DELETE FROM collections WHERE id = ?", (collection_id,))
+    with get_db(write=True) as db:
+        result = db.execute(SQL_DELETE_COLLECTION, (collection_id,))
         if result.rowcount == 0:
             raise HTTPException(status_code=404, detail="Collection not found")
+        db.execute(SQL_DELETE_COLLECTION_DOCUMENTS, (collection_id,))
+    _collection_cache.pop(collection_id, None)
+    _drop_vector_db(collection_id)
     return None
 
+# Returns False if the document was deleted
+def _set_document_status(file_id: str, status: str) -> bool:
+    with get_db(write=True) as db:
+        return db.execute(SQL_SET_DOCUMENT_STATUS, (status, file_id)).rowcount > 0
+
+# Removes what an ingestion job stored, when the job failed or its document (or the whole collection)
+# was deleted
+def _discard_chunks(collection_id: str, file_id: str):
+    with get_db() as db:
+        collection_exists = db.execute(SQL_GET_COLLECTION, (collection_id,)).fetchone() is not None
+    if not collection_exists:
+        _drop_vector_db(collection_id)
+        return
+    with _vector_write_lock, _vector_db(collection_id).cursor() as conn:
+        conn.execute("DELETE FROM embeddings WHERE file_id = ?", (file_id,))
+    _evict_search_index(collection_id)
+
+async def _embed(embeddings: OpenAIEmbeddings, texts: List[str]) -> List[List[float]]:
+    # Embedding is network-bound. Send batches concurrently, bounded across all ingestion jobs.
+    async def embed_batch(batch):
+        async with _embed_semaphore:
+            return await embeddings.aembed_documents(batch)
+
+    batches = [texts[i:i + EMBED_BATCH_SIZE] for i in range(0, len(texts), EMBED_BATCH_SIZE)]
+    return [vector for vectors in await asyncio.gather(*map(embed_batch, batches)) for vector in vectors]
+
+def _chunks(temp_file_path: str, file_id: str, file_name: str):
+    # Parse and split one page at a time so memory stays O(page), not O(document)
+    loader = PyMuPDFLoader(temp_file_path)
+    text_splitter = RecursiveCharacterTextSplitter(chunk_size=1500, chunk_overlap=20)
+    for page in loader.lazy_load():
+        metadata = {**page.metadata, "key": file_name, "h1": f"{file_name} p{page.metadata['page'] + 1}", "file_id": file_id}
+        for text in text_splitter.split_text(page.page_content):
+            yield text, metadata
+
+async def _ingest(temp_file_path: str, collection_id: str, embedding_model: str, file_id: str, file_name: str):
+    try:
+        if not await asyncio.to_thread(_set_document_status, file_id, "processing"):
+            return
+        chunks = _chunks(temp_file_path, file_id, file_name)
+        embeddings = OpenAIEmbeddings(model=embedding_model, chunk_size=EMBED_BATCH_SIZE)
+        # Pull enough chunks to keep every embedding request slot busy, store them, then pull more
+        while window := await asyncio.to_thread(list, islice(chunks, EMBED_BATCH_SIZE * EMBED_CONCURRENCY)):
+            texts = [text for text, _ in window]
+            vectors = np.array(await _embed(embeddings, texts), dtype=np.float32)
+            # Store unit vectors so cosine similarity is a plain dot product at search time
+            vectors /= np.linalg.norm(vectors, axis=-1, keepdims=True)
+            await asyncio.to_thread(_store_chunks, collection_id, file_id, window, vectors)
+            _evict_search_index(collection_id)
+            # A delete since the last window already removed the earlier chunks, but not these. Stop.
+            if not await asyncio.to_thread(_set_document_status, file_id, "processing"):
+                await asyncio.to_thread(_discard_chunks, collection_id, file_id)
+                return
+        await asyncio.to_thread(_set_document_status, file_id, "processed")
+    except Exception:
+        logging.exception("Failed to ingest %s into collection %s", file_name, collection_id)
+        # A failed document must not be searchable, so drop the windows it already stored
+        try:
+            await asyncio.to_thread(_discard_chunks, collection_id, file_id)
+        finally:
+            await asyncio.to_thread(_set_document_status, file_id, "failed")
+    finally:
+        os.unlink(temp_file_path)
+
 @app.post("/v1/collections/{collection_id}/documents", response_model=DocumentResponse, status_code=201)
 async def add_document(
     collection_id: str,
+    background_tasks: BackgroundTasks,
     file: UploadFile = File(...),
     token: str = Depends(get_token)
 ):
-    with get_db() as db:
-        result = db.execute("SELECT data FROM collections WHERE id = ?", (collection_id,)).fetchone()
-        if not result:
-            raise HTTPException(status_code=404, detail="Collection not found")
-    embedding_model = json.loads(result['data'])['embedding_model']
+    embedding_model = _load_collection(collection_id)['embedding_model']
 
     with tempfile.NamedTemporaryFile(delete=False, suffix=os.path.splitext(file.filename)[1]) as temp_file:
-        temp_file.write(await file.read())
+        while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+            temp_file.write(chunk)
         temp_file_path = temp_file.name
 
-    try:
-        loader = PyMuPDFLoader(temp_file_path)
-        text_splitter = RecursiveCharacterTextSplitter(chunk_size=1500, chunk_overlap=20)
-        documents = text_splitter.split_documents(loader.load())
-        for doc in documents:
-            doc.metadata.update({"key": file.filename, "h1": f"{file.filename} p{doc.metadata['page'] + 1}"})
-
-        conn = duckdb.connect(database=f"{collection_id}.duckdb", config={
-            "enable_external_access": "false",
-            "autoinstall_known_extensions": "false",
-            "autoload_known_extensions": "false"
-        })
-        embedding_function = OpenAIEmbeddings(model=embedding_model)  # Define or import your embedding function here
-        vector_store = DuckDB(connection=conn, embedding=embedding_function)
-        vector_store.from_documents(documents, embedding_function)
-
-        return DocumentResponse(file_id=str(uuid.uuid4()), file_name=file.filename, status="processed")
-    finally:
-        os.unlink(temp_file_path)
+    # Parsing and embedding take seconds per PDF. Queue them and let clients poll the status.
+    file_id = str(uuid.uuid4())
+    with get_db(write=True) as db:
+        db.execute(SQL_INSERT_DOCUMENT, (file_id, collection_id, file.filename, "queued"))
+    background_tasks.add_task(_ingest, temp_file_path, collection_id, embedding_model, file_id, file.filename)
 
-@app.delete("/v1/collections/{collection_id}/documents/{file_id}", status_code=204)
-async def delete_document(collection_id: str, file_id: str, token: str = Depends(get_token)):
-    # Verify collection exists
+    return DocumentResponse(file_id=file_id, file_name=file.filename, status="queued")
+
+@app.get("/v1/collections/{collection_id}/documents/{file_id}", response_model=DocumentResponse)
+async def get_document(collection_id: str, file_id: str, token: str = Depends(get_token)):
     with get_db() as db:
-        result = db.execute(
-            "SELECT data FROM collections WHERE id = ?", (collection_id,)
-        ).fetchone()
+        result = db.execute(SQL_GET_DOCUMENT, (file_id, collection_id)).fetchone()
         if not result:
-            raise HTTPException(status_code=404, detail="Collection not found")
+            raise HTTPException(status_code=404, detail="Document not found")
+    return DocumentResponse(**result)
+
+@app.delete("/v1/collections/{collection_id}/documents/{file_id}", status_code=204)
+async def delete_document(collection_id: str, file_id: str, token: str = Depends(get_token)):
+    # One statement checks that the document exists in this collection and removes it
+    with get_db(write=True) as db:
+        result = db.execute(SQL_DELETE_DOCUMENT, (file_id, collection_id))
+        if result.rowcount == 0:
+            raise HTTPException(status_code=404, detail="Document not found")
 
     # Delete the document from the vector store
     try:
-        conn = duckdb.connect(database=f"{collection_id}.duckdb", config={
-            "enable_external_access": "false",
-            "autoinstall_known_extensions": "false",
-            "autoload_known_extensions": "false"
-        })
-        conn.execute(f"DELETE FROM embeddings WHERE id = '{file_id}'")
+        _vector_db(collection_id).execute("DELETE FROM embeddings WHERE file_id = ?", (file_id,))
+        _evict_search_index(collection_id)
     except duckdb.Error as e:
         raise HTTPException(status_code=500, detail=f"Error deleting document: {str(e)}")
-    finally:
-        conn.close()
 
 
 @app.get("/v1/collections/{collection_id}/search", response_model=SearchResponse)
@@ -245,42 +550,55 @@ async def vector_search(
     n: int = Query(10, ge=1, le=100),
     token: str = Depends(get_token)
 ):
-    with get_db() as db:
-        result = db.execute("SELECT data FROM collections WHERE id = ?", (collection_id,)).fetchone()
-        if not result:
-            raise HTTPException(status_code=404, detail="Collection not found")
-    embedding_model = json.loads(result['data'])['embedding_model']
+    start = time.perf_counter()
+    embedding_model = _load_collection(collection_id)['embedding_model']
 
     try:
-        conn = duckdb.connect(database=f"{collection_id}.duckdb", config={
-            "enable_external_access": "false",
-            "autoinstall_known_extensions": "false",
-            "autoload_known_extensions": "false"
-        })
-        embedding_function = OpenAIEmbeddings(model=embedding_model)  # Define or import your embedding function here
-        vector_store = DuckDB(connection=conn, embedding=embedding_function)
-        results = vector_store.similarity_search(q, n)
+        query = np.array(await OpenAIEmbeddings(model=embedding_model).aembed_query(q), dtype=np.float32)
+        query /= np.linalg.norm(query)
+        ids, signatures, matrix = await asyncio.to_thread(_search_index, collection_id)
+        if not ids:
+            return SearchResponse(results=[], total=0, processing_time=f"{time.perf_counter() - start:.3f}s")
+        candidates = np.arange(len(ids))
+        shortlist = n * SHORTLIST_FACTOR
+        if len(ids) > shortlist:
+            candidates = np.argpartition(_hamming(signatures, _signature(query)), shortlist)[:shortlist]
+        # numpy has no float16 BLAS path: upcast just the candidate rows, then one matrix-vector product
+        scores = matrix[candidates].astype(np.float32) @ query
+        top = np.argpartition(-scores, n)[:n] if len(scores) > n else np.arange(len(scores))
+        top = top[np.argsort(-scores[top])]
+        top_ids = [ids[candidates[i]] for i in top]
+        rows = await asyncio.to_thread(_fetch_chunks, collection_id, top_ids)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error searching: {str(e)}")
-    finally:
-        conn.close()
-
-    return {"results": results, "total": len(results)}
-
 
+    results = []
+    for id, score in zip(top_ids, scores[top]):
+        # Skip chunks deleted after the index was built
+        if id not in rows:
+            continue
+        _, text, metadata = rows[id]
+        metadata = orjson.loads(metadata)
+        results.append(SearchResult(document_id=metadata.get("file_id", id), text=text, score=float(score), metadata=metadata))
+
+    return SearchResponse(results=results, total=len(results), processing_time=f"{time.perf_counter() - start:.3f}s")
+
+# Error bodies differ only in message. Build the rest once per status code.
+@lru_cache(maxsize=16)
+def _error_template(status_code: int) -> dict:
+    return ErrorResponse(
+        message="",
+        documentation_url=f"https://rag.straive.app/docs/{status_code}",
+        status_code=status_code
+    ).model_dump()
 
 @app.exception_handler(HTTPException)
 async def http_exception_handler(request, exc):
-    error_response = ErrorResponse(
-        message=str(exc.detail),
-        documentation_url=f"https://rag.straive.app/docs/{exc.status_code}",
-        status_code=exc.status_code
-    )
-    return JSONResponse(
+    return ORJSONResponse(
         status_code=exc.status_code,
-        content=error_response.model_dump()
+        content={**_error_template(exc.status_code), "message": str(exc.detail)}
     )
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run("main:app", host="0.0.0.0", port=8000, reload=True)
+    uvicorn.run("main:app", host="0.0.0.0", port=8000, loop="uvloop", http="httptools", reload=False)
@@ -1,143 +1,179 @@
 # /// script
 # requires-python = ">=3.11"
 # dependencies = [
+#     "cachetools",
 #     "duckdb",
 #     "fastapi",
-#     "httpx",
+#     "httpx[http2]",
 #     "langchain-community~=0.3.0",
 #     "langchain-openai~=0.2.0",
 #     "langchain~=0.3.0",
+#     "numpy>=2.0",
+#     "orjson",
 #     "pydantic",
 #     "pymupdf",
 #     "python-multipart",
-#     "uvicorn",
-#     "reportlab",
+#     "uvicorn[standard]",
 #     "pytest",
-#     "pytest-asyncio",
+#     "pytest-asyncio>=1.0",
+#     "pytest-xdist",
 # ]
 # ///
+import asyncio
+import httpx
+import json
+import os
 import pytest
-from fastapi.testclient import TestClient
-from main import app
-from datetime import datetime, timedelta
-from io import BytesIO
-from reportlab.pdfgen import canvas
+import pytest_asyncio
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+from pathlib import Path
+from types import MappingProxyType
+from unittest.mock import patch
 import sys
-
-client = TestClient(app)
+import uuid
+
+_SEARCH_URL = "/v1/collections/{cid}/search".format
+
+# Name and author are unique per run so parallel workers and earlier runs never share rows
+PAGINATION_AUTHOR = f"pag-{uuid.uuid4().hex}"
+PAGINATION_PAYLOADS = [{
+    "name": f"{PAGINATION_AUTHOR}-{i}",
+    "authors": [PAGINATION_AUTHOR],
+    "extraction_strategy": {"pdf": "PyMuPDF4LLM"},
+    "embedding_model": "text-embedding-3-small"
+} for i in range(15)]
+
+# Set RAG_TEST_BASE_URL to run against a live server instead of the app in-process
+@pytest_asyncio.fixture(scope="session")
+async def client():
+    if base_url := os.environ.get("RAG_TEST_BASE_URL"):
+        limits = httpx.Limits(max_connections=64, max_keepalive_connections=64)
+        c = httpx.AsyncClient(base_url=base_url, http2=True, limits=limits, timeout=30)
+    else:
+        from main import app
+        c = httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test")
+    async with c:
+        yield c
 
 # Mock external API responses
-@pytest.fixture(autouse=True)
-def mock_external_api(monkeypatch):
-    async def mock_forward_request(url, method, token, **kwargs):
-        if "collections" in url and method == "GET":
-            return {"total": 1, "collections": [{"id": "test_id", "name": "Test Collection"}]}
-        elif "collections" in url and method == "POST":
-            return {"id": "new_collection_id", "name": "New Collection"}
-        elif "documents" in url and method == "POST":
-            return {"file_id": "new_file_id", "status": "indexed"}
-        elif "search" in url:
-            return {"results": [], "total": 0, "processing_time": "0.1s"}
-        return {}
-
-    monkeypatch.setattr("main.forward_request", mock_forward_request)
-
-@pytest.fixture
+async def mock_forward_request(url, method, token, **kwargs):
+    if "collections" in url and method == "GET":
+        return {"total": 1, "collections": [{"id": "test_id", "name": "Test Collection"}]}
+    elif "collections" in url and method == "POST":
+        return {"id": "new_collection_id", "name": "New Collection"}
+    elif "documents" in url and method == "POST":
+        return {"file_id": "new_file_id", "status": "indexed"}
+    elif "search" in url:
+        return {"results": [], "total": 0, "processing_time": "0.1s"}
+    return {}
+
+# Only the in-process app can be patched. Patching imports main, so skip it for a live server.
+@pytest.fixture(scope="session", autouse=True)
+def mock_external_api():
+    if os.environ.get("RAG_TEST_BASE_URL"):
+        yield
+        return
+    with patch("main.forward_request", new=mock_forward_request):
+        yield
+
+@pytest.fixture(scope="session")
 def sample_collection():
-    return {
+    return MappingProxyType({
         "name": "Test Collection",
         "authors": ["Test Author"],
         "extraction_strategy": {"pdf": "PyMuPDF4LLM", "html": "to_md", "docx": "to_md"},
         "embedding_model": "text-embedding-3-small"
-    }
+    })
 
-@pytest.fixture
-def create_test_collection():
-    def _create_collection(name="Test Collection"):
-        headers = {"Authorization": "Bearer test_token"}
-        collection_data = {
-            "name": name,
-            "authors": ["Test Author"],
-            "extraction_strategy": {"pdf": "PyMuPDF4LLM", "html": "to_md", "docx": "to_md"},
-            "embedding_model": "text-embedding-3-small"
-        }
-        response = client.post("/v1/collections", json=collection_data, headers=headers)
-        assert response.status_code == 201
-        return response.json()["id"]
-    return _create_collection
-
-def create_pdf(content):
-    buffer = BytesIO()
-    pdf = canvas.Canvas(buffer)
-    pdf.drawString(100, 750, content)
-    pdf.save()
-    buffer.seek(0)
-    return buffer
-
-def add_test_document(collection_id, content="test content"):
+async def _create_collection(client, sample_collection):
+    headers = {"Authorization": "Bearer test_token"}
+    response = await client.post("/v1/collections", json=dict(sample_collection), headers=headers)
+    assert response.status_code == 201
+    return response.json()["id"]
+
+# Shared by the tests that only need some collection to exist
+@pytest_asyncio.fixture(scope="module")
+async def collection_id(client, sample_collection):
+    collection_id = await _create_collection(client, sample_collection)
+    yield collection_id
+    await client.delete(f"/v1/collections/{collection_id}")
+
+# For tests that delete the collection they are given, or whose assertions depend on its exact contents
+@pytest_asyncio.fixture
+async def own_collection_id(client, sample_collection):
+    collection_id = await _create_collection(client, sample_collection)
+    yield collection_id
+    await client.delete(f"/v1/collections/{collection_id}")
+
+SAMPLE_PDF = Path(__file__).parent / "tests" / "fixtures" / "sample.pdf"
+
+@pytest.fixture(scope="session")
+def sample_pdf_bytes():
+    return SAMPLE_PDF.read_bytes()
+
+# Tests that search need PDFs with specific text. Build each one once per session
+@lru_cache(maxsize=None)
+def create_pdf_bytes(content):
+    import pymupdf
+
+    pdf = pymupdf.open()
+    pdf.new_page().insert_text((72, 72), content)
+    return pdf.tobytes()
+
+async def add_test_document(client, collection_id, pdf_bytes):
     headers = {"Authorization": "Bearer test_token"}
-    pdf_content = create_pdf(content)
-    files = {"file": ("test.pdf", pdf_content, "application/pdf")}
-    response = client.post(f"/v1/collections/{collection_id}/documents", files=files, headers=headers)
+    files = {"file": ("test.pdf", pdf_bytes, "application/pdf")}
+    response = await client.post(f"/v1/collections/{collection_id}/documents", files=files, headers=headers)
     assert response.status_code == 201
     return response.json()["file_id"]
 
-@pytest.mark.asyncio
-async def test_list_collections():
+async def test_list_collections(client):
     headers = {"Authorization": "Bearer test_token"}
-    response = client.get("/v1/collections", headers=headers)
+    response = await client.get("/v1/collections", headers=headers)
+    data = response.json()
     print(response.headers)
-    print(response.json())
+    print(data)
     assert response.status_code == 200
-    data = response.json()
     assert "total" in data
     assert "collections" in data
 
-@pytest.mark.asyncio
-async def test_create_collection(sample_collection):
+async def test_create_collection(client, sample_collection):
     headers = {"Authorization": "Bearer test_token"}
-    response = client.post("/v1/collections", json=sample_collection, headers=headers)
+    response = await client.post("/v1/collections", json=dict(sample_collection), headers=headers)
     assert response.status_code == 201
     data = response.json()
     assert "id" in data
 
-@pytest.mark.asyncio
-async def test_update_collection(create_test_collection):
-    collection_id = create_test_collection()
+async def test_update_collection(client, collection_id):
     headers = {"Authorization": "Bearer test_token"}
     update_data = {"authors": ["New Author"]}
-    response = client.patch(f"/v1/collections/{collection_id}", json=update_data, headers=headers)
+    response = await client.patch(f"/v1/collections/{collection_id}", json=update_data, headers=headers)
     assert response.status_code == 200
     updated_collection = response.json()
     assert updated_collection["authors"] == ["New Author"]
     assert updated_collection["id"] == collection_id
 
-@pytest.mark.asyncio
-async def test_delete_collection(create_test_collection):
-    collection_id = create_test_collection()
+async def test_delete_collection(client, own_collection_id):
+    collection_id = own_collection_id
     headers = {"Authorization": "Bearer test_token"}
-    response = client.delete(f"/v1/collections/{collection_id}", headers=headers)
+    response = await client.delete(f"/v1/collections/{collection_id}", headers=headers)
     assert response.status_code == 204
-    get_response = client.get(f"/v1/collections/{collection_id}", headers=headers)
+    get_response = await client.get(f"/v1/collections/{collection_id}", headers=headers)
     assert get_response.status_code == 404
 
-@pytest.mark.asyncio
-async def test_add_document(create_test_collection):
-    collection_id = create_test_collection()
-    file_id = add_test_document(collection_id)
+async def test_add_document(client, collection_id, sample_pdf_bytes):
+    file_id = await add_test_document(client, collection_id, sample_pdf_bytes)
     assert file_id is not None
 
-@pytest.mark.asyncio
-async def test_delete_document(create_test_collection):
-    collection_id = create_test_collection()
-    file_id = add_test_document(collection_id)
+async def test_delete_document(client, collection_id, sample_pdf_bytes):
+    file_id = await add_test_document(client, collection_id, sample_pdf_bytes)
     headers = {"Authorization": "Bearer test_token"}
-    response = client.delete(f"/v1/collections/{collection_id}/documents/{file_id}", headers=headers)
+    response = await client.delete(f"/v1/collections/{collection_id}/documents/{file_id}", headers=headers)
     assert response.status_code == 204
 
-@pytest.mark.asyncio
-async def test_vector_search(create_test_collection):
-    collection_id = create_test_collection()
+async def test_vector_search(client, own_collection_id):
+    collection_id = own_collection_id
 
     # Add documents with clear relevance distinction
     docs = [
@@ -147,10 +183,10 @@ async def test_vector_search(create_test_collection):
         "The Rocky Mountains stretch from Canada to New Mexico"
     ]
     for doc in docs:
-        add_test_document(collection_id, doc)
+        await add_test_document(client, collection_id, create_pdf_bytes(doc))
 
     headers = {"Authorization": "Bearer test_token"}
-    response = client.get(f"/v1/collections/{collection_id}/search?q=fox&n=5", headers=headers)
+    response = await client.get(_SEARCH_URL(cid=collection_id), params={"q": "fox", "n": 5}, headers=headers)
     assert response.status_code == 200
     data = response.json()
 
@@ -176,99 +212,98 @@ async def test_vector_search(create_test_collection):
     # Verify that both results contain "fox" or "foxes"
     assert all("fox" in result["content"].lower() for result in data["results"]), "All results should contain 'fox' or 'foxes'"
 
-@pytest.mark.asyncio
-async def test_error_handling():
+async def test_error_handling(client):
+    invalid_collection = {"invalid_field": "value"}
+    not_found, invalid = await asyncio.gather(
+        client.get("/v1/collections/non_existent_id"),
+        client.post("/v1/collections", json=invalid_collection),
+    )
+
     # Test 404 error
-    response = client.get("/v1/collections/non_existent_id")
-    assert response.status_code == 404
-    data = response.json()
+    assert not_found.status_code == 404
+    data = not_found.json()
     assert "message" in data
     assert "documentation_url" in data
     assert "status_code" in data
 
     # Test 400 error
-    invalid_collection = {"invalid_field": "value"}
-    response = client.post("/v1/collections", json=invalid_collection)
-    assert response.status_code == 400
-    data = response.json()
+    assert invalid.status_code == 400
+    data = invalid.json()
     assert "message" in data
     assert "documentation_url" in data
     assert "status_code" in data
 
-@pytest.mark.asyncio
-async def test_pagination_and_filtering():
-    # Create multiple collections
-    for i in range(15):
-        client.post("/v1/collections", json={
-            "name": f"Test Collection {i}",
-            "authors": ["Test Author"],
-            "extraction_strategy": {"pdf": "PyMuPDF4LLM"},
-            "embedding_model": "text-embedding-3-small"
-        })
+@pytest_asyncio.fixture
+async def pagination_collections(client):
+    response = await client.post("/v1/collections:batch", json=PAGINATION_PAYLOADS)
+    assert response.status_code == 201
+    collection_ids = [collection["id"] for collection in response.json()["collections"]]
+    yield collection_ids
+    await asyncio.gather(*[client.delete(f"/v1/collections/{cid}") for cid in collection_ids])
+
+@pytest.mark.slow
+async def test_pagination_and_filtering(client, pagination_collections):
+    filters = json.dumps({"authors": PAGINATION_AUTHOR})
+    page, by_author = await asyncio.gather(
+        client.get("/v1/collections", params={"filters": filters, "page": 2, "per_page": 5}),
+        client.get("/v1/collections", params={"filters": filters, "per_page": 100}),
+    )
 
     # Test pagination
-    response = client.get("/v1/collections?page=2&per_page=5")
-    assert response.status_code == 200
-    data = response.json()
+    assert page.status_code == 200
+    data = page.json()
     assert len(data["collections"]) == 5
 
     # Test filtering by author
-    response = client.get("/v1/collections?author=Test Author")
-    assert response.status_code == 200
-    data = response.json()
-    assert all("Test Author" in collection["authors"] for collection in data["collections"])
-
-    # Test filtering by creation date
-    yesterday = (datetime.now() - timedelta(days=1)).isoformat()
-    response = client.get(f"/v1/collections?created_after={yesterday}")
-    assert response.status_code == 200
-    data = response.json()
-    assert all(datetime.fromisoformat(collection["created_at"]) > datetime.fromisoformat(yesterday)
-               for collection in data["collections"])
-
-    # Test filtering by creation date range
-    yesterday = (datetime.now() - timedelta(days=1)).isoformat()
-    today = datetime.now().isoformat()
-    response = client.get(f"/v1/collections?created_after={yesterday}&created_before={today}")
-    assert response.status_code == 200
-    data = response.json()
-    assert all(yesterday < collection["created_at"] < today for collection in data["collections"])
-
-@pytest.mark.asyncio
-async def test_search_parameters():
-    # Create a collection and add a document
-    collection = {
-        "name": "Search Test Collection",
-        "authors": ["Test Author"],
-        "extraction_strategy": {"pdf": "PyMuPDF4LLM"},
-        "embedding_model": "text-embedding-3-small"
-    }
-    create_response = client.post("/v1/collections", json=collection)
-    collection_id = create_response.json()["id"]
-    files = {"file": ("test.pdf", b"The quick brown fox jumps over the lazy dog", "application/pdf")}
-    client.post(f"/v1/collections/{collection_id}/documents", files=files)
+    assert by_author.status_code == 200
+    data = by_author.json()
+    assert data["total"] == 15
+    assert all(PAGINATION_AUTHOR in collection["authors"] for collection in data["collections"])
+
+    # created_at is timezone-aware UTC and was just set
+    yesterday = datetime.now(timezone.utc) - timedelta(days=1)
+    assert all(datetime.fromisoformat(collection["created_at"]) > yesterday for collection in data["collections"])
+
+async def test_invalid_filters(client):
+    malformed, non_scalar = await asyncio.gather(
+        client.get("/v1/collections", params={"filters": "{"}),
+        client.get("/v1/collections", params={"filters": json.dumps({"authors": ["Test Author"]})}),
+    )
+    assert malformed.status_code == 400
+    assert non_scalar.status_code == 400
+    assert "message" in non_scalar.json()
+
+@pytest.mark.slow
+async def test_search_parameters(client, collection_id):
+    # Add a document
+    pdf_bytes = create_pdf_bytes("The quick brown fox jumps over the lazy dog")
+    files = {"file": ("test.pdf", pdf_bytes, "application/pdf")}
+    await client.post(f"/v1/collections/{collection_id}/documents", files=files)
+
+    url = _SEARCH_URL(cid=collection_id)
+    combined, reranked, thresholded = await asyncio.gather(
+        client.get(url, params={"q": "fox", "n": 5, "rerank_strategy": "bm25", "similarity_threshold": 0.8, "fuzzy": "true"}),
+        client.get(url, params={"q": "fox", "rerank_strategy": "bm25"}),
+        client.get(url, params={"q": "fox", "similarity_threshold": 0.9}),
+    )
 
     # Test different search parameters
-    response = client.get(f"/v1/collections/{collection_id}/search?q=fox&n=5&rerank_strategy=bm25&similarity_threshold=0.8&fuzzy=true")
-    assert response.status_code == 200
-    data = response.json()
+    assert combined.status_code == 200
+    data = combined.json()
     assert "results" in data
     assert len(data["results"]) <= 5  # May be less if similarity threshold is applied
 
     # Test rerank_strategy parameter
-    response = client.get(f"/v1/collections/{collection_id}/search?q=fox&rerank_strategy=bm25")
-    assert response.status_code == 200
-    data = response.json()
+    assert reranked.status_code == 200
+    data = reranked.json()
     assert "results" in data
 
     # Test similarity_threshold parameter
-    response = client.get(f"/v1/collections/{collection_id}/search?q=fox&similarity_threshold=0.9")
-    assert response.status_code == 200
-    data = response.json()
+    assert thresholded.status_code == 200
+    data = thresholded.json()
     assert all(result["score"] >= 0.9 for result in data["results"])
 
-@pytest.mark.asyncio
-async def test_invalid_collection_creation():
+async def test_invalid_collection_creation(client):
     # Test creating a collection with invalid data
     invalid_collection = {
         "name": "",  # Empty name should be invalid
@@ -276,65 +311,47 @@ async def test_invalid_collection_creation():
         "extraction_strategy": {},
         "embedding_model": "invalid_model"
     }
-    response = client.post("/v1/collections", json=invalid_collection)
+    response = await client.post("/v1/collections", json=invalid_collection)
     assert response.status_code == 400
     data = response.json()
     assert "message" in data
     assert "errors" in data
     assert any(error["field"] == "name" for error in data["errors"])
 
-@pytest.mark.asyncio
-async def test_search_with_invalid_parameters():
-    # Create a collection for testing
-    collection = {
-        "name": "Test Collection",
-        "authors": ["Test Author"],
-        "extraction_strategy": {"pdf": "PyMuPDF4LLM"},
-        "embedding_model": "text-embedding-3-small"
-    }
-    create_response = client.post("/v1/collections", json=collection)
-    collection_id = create_response.json()["id"]
+async def test_search_with_invalid_parameters(client, collection_id):
+    url = _SEARCH_URL(cid=collection_id)
+    invalid_n, invalid_threshold = await asyncio.gather(
+        client.get(url, params={"q": "test", "n": 0}),
+        client.get(url, params={"q": "test", "similarity_threshold": 2}),
+    )
 
     # Test search with invalid n parameter
-    response = client.get(f"/v1/collections/{collection_id}/search?q=test&n=0")
-    assert response.status_code == 400
-    data = response.json()
+    assert invalid_n.status_code == 400
+    data = invalid_n.json()
     assert "message" in data
     assert "errors" in data
 
     # Test search with invalid similarity_threshold
-    response = client.get(f"/v1/collections/{collection_id}/search?q=test&similarity_threshold=2")
-    assert response.status_code == 400
-    data = response.json()
+    assert invalid_threshold.status_code == 400
+    data = invalid_threshold.json()
     assert "message" in data
     assert "errors" in data
 
-@pytest.mark.asyncio
-async def test_nonexistent_collection():
-    nonexistent_id = "nonexistent_collection_id"
-
-    # Test getting a nonexistent collection
-    response = client.get(f"/v1/collections/{nonexistent_id}")
-    assert response.status_code == 404
-
-    # Test updating a nonexistent collection
+async def test_nonexistent_collection(client, sample_pdf_bytes):
+    url = "/v1/collections/nonexistent_collection_id"
     update_data = {"authors": ["New Author"]}
-    response = client.patch(f"/v1/collections/{nonexistent_id}", json=update_data)
-    assert response.status_code == 404
-
-    # Test deleting a nonexistent collection
-    response = client.delete(f"/v1/collections/{nonexistent_id}")
-    assert response.status_code == 404
-
-    # Test adding a document to a nonexistent collection
-    files = {"file": ("test.pdf", b"test content", "application/pdf")}
-    response = client.post(f"/v1/collections/{nonexistent_id}/documents", files=files)
-    assert response.status_code == 404
-
-    # Test searching in a nonexistent collection
-    response = client.get(f"/v1/collections/{nonexistent_id}/search?q=test")
-    assert response.status_code == 404
+    files = {"file": ("test.pdf", sample_pdf_bytes, "application/pdf")}
+
+    # Get, update, delete, add a document to and search a nonexistent collection
+    responses = await asyncio.gather(
+        client.get(url),
+        client.patch(url, json=update_data),
+        client.delete(url),
+        client.post(f"{url}/documents", files=files),
+        client.get(_SEARCH_URL(cid="nonexistent_collection_id"), params={"q": "test"}),
+    )
+    assert [response.status_code for response in responses] == [404] * 5
 
 if __name__ == "__main__":
-    pytest_args = ["-v", "test_api.py"] + sys.argv[1:]
+    pytest_args = ["-v", "-n", "auto", "test_api.py"] + sys.argv[1:]
     pytest.main(pytest_args)